@@ -1,57 +1,158 @@
 import pyglet
 from . import config
 from . import sprites
-from .render import Render
+from .render import Render, SceneTarget, Upscaler, fit_viewport
 from . import gllib as gl
 from .game import Game
+from .ghosts import GhostRace, append_runs
+from .autopilot import Autopilot
+from .stream import StreamServer, StreamClient, Spectator
+from .dataset import Recorder
+from .collision import CollisionMasks
+from .scheduler import FrameScheduler
 from . import ui
 
 class App(pyglet.window.Window):
     def __init__(self):
         super().__init__(
             caption=config.caption,
-            resizable=False,
+            resizable=True,
+            vsync=config.vsync,
             width=config.screenWidth * config.zoom,
             height=config.screenHeight * config.zoom,
         )
         sprites.init()
         self.init_gl()
         self.render = Render()
+        self.sceneTarget = SceneTarget()
+        self.upscaler = Upscaler()
+        self._viewport = (0, 0, self.width, self.height)
+        # (issued, skipped) GL calls of the last frame
+        self.glCalls = (0, 0)
         self._fbContext = None
+        self._nextContext = None
+        # Ready to use contexts by class, and used ones awaiting a reset
+        self._spareContexts = {}
+        self._usedContexts = {}
+        self.collisionMasks = CollisionMasks.load()
+        self.ghosts = None
+        if config.ghostFile is not None:
+            self.ghosts = GhostRace.load(config.ghostFile)
+        # Trajectories of finished runs, stored on exit
+        self.ghostRuns = None if config.ghostRecordFile is None else []
+        # Loaded once here, the A key only toggles autopilotEnabled
+        self.autopilot = Autopilot.load()
+        self.autopilotEnabled = config.autopilot
+        self.streamServer = None
+        self.streamClient = None
+        self.recorder = None
+        if config.recordDir is not None:
+            self.recorder = Recorder(
+                config.recordDir,
+                imageShape=(config.screenHeight, config.screenWidth, 3)
+                if config.recordImages else None)
 
-        self.set_context(Game)
-        pyglet.clock.schedule_interval(self.update, 1 / config.FPS)
+        if config.spectate:
+            self.streamClient = StreamClient()
+            self.streamClient.start()
+            self.set_context(Spectator)
+        else:
+            if config.streamPort is not None:
+                self.streamServer = StreamServer()
+                self.streamServer.start()
+            self.set_context(Game)
+        self.scheduler = FrameScheduler(
+            self, self.update, idle=self.prepare_contexts,
+            mustDraw=self.image_pending)
+
+    def image_pending(self):
+        """
+        Whether the last update was recorded and waits for its image, so it
+        has to be drawn before the next update.
+        """
+        return self.recorder is not None and self.recorder.imagePending
 
     def set_context(self, contextClass):
-        self._fbContext = contextClass(self)
+        """
+        Switch to a context of contextClass at the next frame boundary.
+        """
+        self._nextContext = contextClass
+        if self._fbContext is None:
+            self._switch_context()
+
+    def _switch_context(self):
+        contextClass = self._nextContext
+        self._nextContext = None
+        context = self._spareContexts.pop(contextClass, None)
+        if context is None:
+            context = contextClass(self)
+        if self._fbContext is not None:
+            self._usedContexts[type(self._fbContext)] = self._fbContext
+        self._fbContext = context
+        context.on_enter()
+
+    def prepare_contexts(self):
+        """
+        Get the context likely to come next ready, reusing a used one where
+        possible. Does one step per call; the scheduler calls it with time to
+        spare before the next frame. Return whether there was work left.
+        """
+        nextClass = self._fbContext.next_context()
+        if nextClass is None or nextClass in self._spareContexts:
+            return False
+        context = self._usedContexts.pop(nextClass, None)
+        if context is None:
+            context = nextClass(self)
+        else:
+            context.reset()
+        self._spareContexts[nextClass] = context
+        return True
 
     def init_gl(self):
-        gl.glDisable(gl.GL_DEPTH_TEST)
-        gl.glEnable(gl.GL_TEXTURE_2D)
-        gl.glClearColor(1., 1., 1., 1.)
-        gl.glEnable(gl.GL_BLEND)
-        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        gl.state.disable(gl.GL_DEPTH_TEST)
+        gl.state.enable(gl.GL_TEXTURE_2D)
+        gl.state.clear_color(1., 1., 1., 1.)
+        gl.state.enable(gl.GL_BLEND)
+        gl.state.blend_func(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
 
     def run(self):
-        pyglet.app.run()
+        self.scheduler.run()
+        if self.ghostRuns:
+            append_runs(config.ghostRecordFile, self.ghostRuns)
+        if self.recorder is not None:
+            self.recorder.close()
 
     def on_resize(self, w, h):
         self._width = w
         self._height = h
-        gl.glViewport(0, 0, w, h)
+        self._viewport = fit_viewport(
+            (w, h), (config.screenWidth, config.screenHeight), config.scaleMode)
 
     def on_draw(self):
-        self.clear()
         R = self.render
         context = self._fbContext
-        with R.batch_draw():
-            R.draw_sprites(context.sprites)
+        with self.sceneTarget.bind():
+            gl.state.clear_color(1., 1., 1., 1.)
+            gl.state.clear()
+            with R.batch_draw():
+                R.draw_sprites(context.sprites)
+                for batch in context.batches:
+                    batch.draw(R)
+        if self.image_pending():
+            self.sceneTarget.read_pixels(self.recorder.last_image())
+
+        gl.state.viewport(0, 0, self._width, self._height)
+        gl.state.clear_color(*config.letterboxColor)
+        gl.state.clear()
+        gl.state.viewport(*self._viewport)
+        with self.upscaler.batch_draw():
+            self.upscaler.draw_texture(self.sceneTarget.texture)
+        self.glCalls = gl.state.end_frame()
 
     def convert_mouse_pos(self, x, y):
-        x -= self._width / 2
-        y -= self._height / 2
-        x *= config.screenWidth / self._width
-        y *= config.screenHeight / self._height
+        x0, y0, w, h = self._viewport
+        x = (x - x0) / w * config.screenWidth - config.screenWidth / 2
+        y = (y - y0) / h * config.screenHeight - config.screenHeight / 2
         return (x, y)
 
     def on_mouse_press(self, x, y, button, modifiers):
@@ -65,7 +166,15 @@ class App(pyglet.window.Window):
     def on_key_press(self, key, modifiers):
         if key == pyglet.window.key.ESCAPE:
             pyglet.app.exit()
+        elif key == pyglet.window.key.A:
+            self.autopilotEnabled = not self.autopilotEnabled
         self._fbContext.on_key_press(key, modifiers)
 
     def update(self, dt):
+        if self._nextContext is not None:
+            self._switch_context()
         self._fbContext.update(dt)
+        if self.streamServer is not None and isinstance(self._fbContext, Game):
+            self.streamServer.publish(self._fbContext)
+        if self.recorder is not None and isinstance(self._fbContext, Game):
+            self.recorder.record_game(self._fbContext)
@@ -0,0 +1,356 @@
+import math
+import os
+import numpy as np
+from . import config
+from . import sprites
+from .bird import Bird
+from .collision import CollisionMasks
+
+
+def flap_trajectory():
+    """
+    Closed form of Bird.update right after a flap. The flap resets the
+    vertical speed, so the path does not depend on the state it starts from.
+    Return (heights, speeds): heights[k] is the height gained after k + 1
+    updates, speeds[k] the vertical speed used by update k + 1. One extra
+    speed is appended, the speed once the flap impulse has run out.
+    """
+    heights = []
+    speeds = []
+    y = vy = 0.
+    coldDown = config.speedGainColdDown
+    while coldDown > 0:
+        speeds.append(vy)
+        y += vy
+        vy -= config.gravity
+        vy += coldDown * 0.08
+        coldDown -= 1
+        vy = min(max(vy, -config.maxDownSpeed), config.maxUpSpeed)
+        heights.append(y)
+    speeds.append(vy)
+    return np.array(heights), np.array(speeds)
+
+
+def fall_speeds():
+    """
+    Vertical speeds k frames after a flap's impulse has run out, until the
+    bird falls at full speed. A flap resets the speed and every run starts
+    with one, so these are the only speeds the bird has when it can flap.
+    """
+    _, speeds = flap_trajectory()
+    vy = speeds[-1]
+    result = [vy]
+    while vy > -config.maxDownSpeed:
+        vy = max(vy - config.gravity, -config.maxDownSpeed)
+        result.append(vy)
+    return np.array(result)
+
+
+def observe(game):
+    """
+    Return (dx, dy, vy, coldDown) of a running game: horizontal distance from
+    the bird to the next pillar it can still touch, height above that
+    pillar's notch center, vertical speed and flap impulse frames left.
+    """
+    bird = game.bird
+    birdX, birdY = bird.screenPos
+    nearest = None
+    for pillar in game.upperPillars:
+        dx = int(round(pillar.x - game._viewX - birdX))
+        if dx >= Autopilot.DX_PASSED and (nearest is None or dx < nearest[0]):
+            nearest = (dx, pillar.offset)
+    dx, offset = nearest
+    return dx, float(birdY) - offset, bird.speed[1], bird._flapGainColdDown
+
+
+def safe_heights(masks, dxs, angles):
+    """
+    The heights above a notch center the bird may have without touching the
+    pillars, by the masks Game tests collisions with.
+    Return (lo, hi) arrays over (dx, angle): dy is safe if lo <= dy < hi.
+    A falling bird shows a single frame; otherwise every frame of its
+    animation has to be safe.
+    """
+    birdX = config.birdInitPos[0]
+    upper = masks.masks_of(sprites.UpperPillar.maskColor)[0]
+    lower = masks.masks_of(sprites.LowerPillar.maskColor)[0]
+    lo = np.full((len(dxs), len(angles)), -np.inf)
+    hi = np.full((len(dxs), len(angles)), np.inf)
+    for i, dx in enumerate(dxs):
+        upperPos = (birdX + dx, sprites.UpperPillar.initY)
+        lowerPos = (birdX + dx, sprites.LowerPillar.initY)
+        for j, angle in enumerate(angles):
+            colors = [Bird.maskColors[1]] if angle < 0 else set(Bird.maskColors)
+            for color in colors:
+                mask = masks.masks_of(color)[masks.angle_index(angle)]
+                x0 = mask.corner((birdX, 0))[0]
+                x1 = upper.corner(upperPos)[0]
+                if x0 + mask.width <= x1 or x0 >= x1 + upper.width:
+                    continue
+
+                def hits(n):
+                    # Bird placed so that its mask's lowest row is at n
+                    pos = (birdX, n - mask.bottom)
+                    return mask.overlaps(pos, upper, upperPos)\
+                        or mask.overlaps(pos, lower, lowerPos)
+
+                n0 = math.floor(-mask.bottom + .5)
+                if hits(n0):
+                    lo[i, j], hi[i, j] = np.inf, -np.inf
+                    continue
+                top = n0
+                while not hits(top + 1) and top < config.screenHeight:
+                    top += 1
+                bottom = n0
+                while not hits(bottom - 1) and bottom > -config.screenHeight:
+                    bottom -= 1
+                # The lowest row lands on floor(dy + mask.bottom + .5)
+                lo[i, j] = max(lo[i, j], bottom - .5 - mask.bottom)
+                hi[i, j] = min(hi[i, j], top + .5 - mask.bottom)
+    return lo, hi
+
+
+class Autopilot:
+    """
+    Decides whether to flap with a single lookup into a precomputed policy
+    table for states where a flap is possible. A state is the distance to
+    the pillar, the height above its notch center the bird had when its
+    last flap ran out, and the frames since, so that waiting moves through
+    the table without rounding the height.
+    The table is built backwards by value iteration, testing the bird
+    against the same collision masks as Game: for both waiting one frame and
+    flapping, followed by the closed form flap path, it keeps the discounted
+    number of frames the bird flies without touching a pillar, averaged over
+    where the notch after the next one may be, and picks the action that
+    flies longest.
+    """
+    # Past this distance the bird cannot touch the pillar any more
+    DX_PASSED = -(config.pillarWidth // 2 + 12)
+    DX_MIN = DX_PASSED - config.speedGainColdDown
+    # Far enough to plan the approach to the first pillar of a run
+    DX_MAX = int(config.beginDistance - config.birdInitPos[0])
+    DY_MIN, DY_MAX = -128, 128
+    # Table rows per pixel of height
+    DY_RES = 8
+    # Pixels kept between the bird's safe heights and the notch edges,
+    # covering the height grid and the float32 bird position
+    MARGIN = .25
+    # Per frame discount of the flight time maximized by the policy
+    DISCOUNT = .99
+    # Passes over the table, each one looks one pillar further ahead
+    SWEEPS = 8
+
+    _speeds = fall_speeds()
+    # Height lost k frames after a flap ran out
+    _drops = np.concatenate([[0.], np.cumsum(_speeds[:-1])])
+    _nDx = DX_MAX - DX_MIN + 1
+    # Rows of the starting height, deep enough for any height of the fall
+    # to still be in [DY_MIN, DY_MAX)
+    _nRows = int(math.ceil((DY_MAX - DY_MIN - _drops[-1]) * DY_RES))
+    _nVy = len(_speeds)
+
+    def __init__(self, packedTable):
+        # A bytes object indexes faster than a numpy array from Python code
+        self._bits = bytes(packedTable)
+        self._packed = np.frombuffer(self._bits, dtype=np.uint8)
+
+    @classmethod
+    def cache_key(cls):
+        return np.array(repr([
+            config.gravity, config.maxUpSpeed, config.maxDownSpeed,
+            config.speedGainColdDown, config.notchHeight, config.pillarWidth,
+            config.scrollDistancePerFrame, config.birdInitPos, Bird.MAX_ANGLE,
+            cls.DX_MIN, cls.DX_MAX, cls.DY_MIN, cls.DY_MAX, cls.DY_RES,
+            cls.MARGIN, cls.DISCOUNT, cls.SWEEPS, config.gapWidth,
+            config.notchCenterRange, str(CollisionMasks.cache_key()),
+        ]))
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Load the table from the cache, building and storing it when missing
+        or built for different physics.
+        """
+        if path is None:
+            path = os.path.join(config.cacheDir, 'autopilot.npz')
+        key = cls.cache_key()
+        if os.path.exists(path):
+            with np.load(path) as data:
+                if np.array_equal(data['key'], key):
+                    return cls(data['table'])
+        table = cls.build()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez_compressed(path, key=key, table=table)
+        return cls(table)
+
+    @staticmethod
+    def _angles(vy):
+        return np.minimum(
+            Bird.MAX_ANGLE, np.arctan2(vy, config.scrollDistancePerFrame))
+
+    @classmethod
+    def _row_index(cls, base):
+        return np.floor((base - cls.DY_MIN) * cls.DY_RES + .5).astype(np.intp)
+
+    @classmethod
+    def build(cls, masks=None):
+        """
+        Compute the policy table. Return it bit packed.
+        """
+        if masks is None:
+            masks = CollisionMasks.load()
+        heights, speeds = flap_trajectory()
+        vys = cls._speeds
+        nFlap = len(heights)
+        nVy = cls._nVy
+        nRows = cls._nRows
+        bases = cls.DY_MIN + np.arange(nRows) / cls.DY_RES
+        # Height above the notch center of every state, and after waiting
+        ys = bases[:, None] + cls._drops[None, :]
+        waited = ys + vys[None, :]
+        inRange = (waited >= cls.DY_MIN) & (waited < cls.DY_MAX)
+        below = ys < 0
+
+        # Safe heights for every angle the bird can have, by dx
+        dxs = np.arange(cls.DX_MIN, cls.DX_MAX + 1)
+        angles = np.concatenate([cls._angles(vys), cls._angles(speeds[:-1])])
+        lo, hi = safe_heights(masks, dxs, angles)
+        lo += cls.MARGIN
+        hi -= cls.MARGIN
+        waitLo, flapLo = lo[:, :nVy], lo[:, nVy:]
+        waitHi, flapHi = hi[:, :nVy], hi[:, nVy:]
+
+        # Waiting keeps the starting height until the bird falls at full
+        # speed, from then on the starting height drops with it
+        nextVy = np.minimum(np.arange(nVy) + 1, nVy - 1)
+        nextRow = np.repeat(np.arange(nRows)[:, None], nVy, axis=1)
+        nextRow[:, -1] -= int(round(config.maxDownSpeed * cls.DY_RES))
+        nextRow = np.clip(nextRow, 0, nRows - 1)
+        # A flap ends where the next fall starts
+        landed = ys + heights[-1]
+        landRow = cls._row_index(landed)
+        landValid = (landed >= cls.DY_MIN) & (landed < cls.DY_MAX)\
+            & (landRow < nRows)
+        landRow = np.clip(landRow, 0, nRows - 1)
+
+        # The next notch is offset from the current one by the difference of
+        # two uniform draws from notchCenterRange.
+        gap = int(config.gapWidth)
+        low, high = config.notchCenterRange
+        n = high - low + 1
+        shifts = np.arange(1 - n, n) * cls.DY_RES
+        weights = (n - np.abs(np.arange(1 - n, n))) / n ** 2
+
+        def expect_next(table):
+            "Expected value once the next pillar becomes the target."
+            out = np.zeros_like(table)
+            for d, w in zip(shifts, weights):
+                if d >= 0:
+                    out[d:] += w * table[:nRows - d]
+                else:
+                    out[:d] += w * table[-d:]
+            return out
+
+        gamma = cls.DISCOUNT
+        survived = (1 - gamma ** np.arange(nFlap + 1)) / (1 - gamma)
+        # Frames of the flap path flown safely, which does not depend on the
+        # values
+        flapFrames = np.zeros((cls._nDx, nRows, nVy), dtype=np.int8)
+        for i, dx in enumerate(dxs):
+            if dx < cls.DX_PASSED:
+                continue
+            hitAt = np.full((nRows, nVy), nFlap, dtype=np.int8)
+            for k in range(nFlap):
+                flown = ys + heights[k]
+                ok = (flown >= flapLo[i - k, k]) & (flown < flapHi[i - k, k])
+                hitAt[(hitAt == nFlap) & ~ok] = k
+            flapFrames[i] = hitAt
+
+        # Discounted number of frames flown from each state
+        values = np.zeros((cls._nDx, nRows, nVy), dtype=np.float32)
+        policy = np.zeros(values.shape, dtype=bool)
+        for sweep in range(cls.SWEEPS):
+            for i, dx in enumerate(dxs):
+                if dx < cls.DX_PASSED:
+                    values[i] = expect_next(values[i + gap])
+                    policy[i] = below
+                    continue
+                # Wait one frame
+                ok = inRange & (waited >= waitLo[i]) & (waited < waitHi[i])
+                waitValue = np.where(
+                    ok, 1 + gamma * values[i - 1][nextRow, nextVy], 0)
+                # Flap now and follow the flap path until it can flap again
+                hitAt = flapFrames[i]
+                flapValue = survived[hitAt] + np.where(
+                    (hitAt == nFlap) & landValid,
+                    gamma ** nFlap * values[i - nFlap][landRow, 0], 0)
+
+                values[i] = np.maximum(waitValue, flapValue)
+                # On a tie prefer climbing towards the notch center
+                policy[i] = (flapValue > waitValue) | (
+                    (flapValue == waitValue) & below)
+        return np.packbits(policy.ravel())
+
+    def _vy_index(self, vy):
+        k = math.floor((self._speeds[0] - vy) / config.gravity + .5)
+        return 0 if k < 0 else self._nVy - 1 if k >= self._nVy else k
+
+    def decide(self, dx, dy, vy, coldDown):
+        """
+        Return True if the bird should flap now.
+        This is the per frame path of control(), a few microseconds of
+        CPython call overhead around one bit lookup. Decide large batches of
+        states with decide_many instead.
+        """
+        if coldDown:
+            return False
+        if dy < self.DY_MIN or dy >= self.DY_MAX:
+            return dy < 0
+        k = self._vy_index(vy)
+        iy = math.floor(
+            (dy - self._drops[k] - self.DY_MIN) * self.DY_RES + .5)
+        if iy < 0 or iy >= self._nRows:
+            return dy < 0
+        ix = (self.DX_MIN if dx < self.DX_MIN else
+              self.DX_MAX if dx > self.DX_MAX else dx) - self.DX_MIN
+        bit = (ix * self._nRows + iy) * self._nVy + k
+        return bool(self._bits[bit >> 3] >> (7 - (bit & 7)) & 1)
+
+    def decide_many(self, dx, dy, vy, coldDown):
+        """
+        Vectorized decide over arrays of states, well under 100 ns a state.
+        """
+        dy = np.asarray(dy)
+        ix = np.clip(dx, self.DX_MIN, self.DX_MAX) - self.DX_MIN
+        k = np.floor((self._speeds[0] - np.asarray(vy)) / config.gravity + .5)
+        k = np.clip(k, 0, self._nVy - 1).astype(np.intp)
+        iy = self._row_index(dy - self._drops[k])
+        inRange = (dy >= self.DY_MIN) & (dy < self.DY_MAX)\
+            & (iy >= 0) & (iy < self._nRows)
+        iy = np.clip(iy, 0, self._nRows - 1)
+        bit = (ix * self._nRows + iy) * self._nVy + k
+        flap = (self._packed[bit >> 3] >> (7 - (bit & 7))) & 1
+        flap = np.where(inRange, flap.astype(bool), dy < 0)
+        return flap & (np.asarray(coldDown) == 0)
+
+    def control(self, game):
+        """
+        Return True if the bird of a running game should flap now.
+        """
+        dx, dy, vy, coldDown = observe(game)
+        if coldDown:
+            return False
+        # The table is relative to the notch and does not know the floor.
+        # A flap stops the fall at once, so look one frame ahead.
+        bird = game.bird
+        masks = game.masks
+        mask = masks.masks_of(bird.maskColor)[
+            masks.angle_index(float(self._angles(vy)))]
+        x, y = bird.screenPos
+        if mask.overlaps((x, y + vy), masks.mask(game.floor), game.floor.screenPos):
+            return True
+        return self.decide(dx, dy, vy, coldDown)
+
+
+if __name__ == '__main__':
+    Autopilot.load()
@@ -14,9 +14,14 @@ class Bird(BaseSprite):
     SHAPE_RADIUS_B = 6
 
     def __init__(self):
+        self._screenPos = np.array(config.birdInitPos, dtype=gl.GLfloat)
+        self.reset()
+
+    def reset(self):
         self.currentFrame = 0
+        self.angle = 0.
         self.effects = []
-        self._screenPos = np.array(config.birdInitPos, dtype=gl.GLfloat)
+        self.screenPos = config.birdInitPos
         self.speed = [config.scrollDistancePerFrame, 0]
         self._flapColdDown = self._flapColdDOwn0 = config.FPS // 12
         self.started = False
@@ -32,9 +37,12 @@ class Bird(BaseSprite):
         self._hit = True
 
     def flap(self):
+        "Return whether the flap took effect."
         if self._flapGainColdDown == 0 and self.screenPos[1] < config.screenHeight / 2:
             self.speed[1] = 0
             self._flapGainColdDown = config.speedGainColdDown
+            return True
+        return False
 
     def update(self, dt):
         self.update_effects(dt)
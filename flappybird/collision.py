@@ -0,0 +1,212 @@
+import hashlib
+import math
+import os
+import Image
+import numpy as np
+from . import config
+from .bird import Bird
+from .render import atlas_boxes, get_resource_path
+
+# Texels with at least this alpha are solid
+ALPHA_THRESHOLD = 128
+
+
+def _round(x):
+    return int(math.floor(x + .5))
+
+
+class Mask:
+    """
+    A bit packed silhouette. rows[j] is the j-th pixel row from the bottom,
+    bit i of it the i-th column from the left. (left, bottom) is the offset
+    of the lower left corner from the sprite's center.
+    """
+    __slots__ = ('left', 'bottom', 'width', 'rows')
+
+    def __init__(self, left, bottom, width, rows):
+        self.left = left
+        self.bottom = bottom
+        self.width = width
+        self.rows = rows
+
+    @classmethod
+    def from_array(cls, solid, left, bottom):
+        """
+        solid: (height, width) bool array, rows from the bottom.
+        Empty border rows and columns are trimmed.
+        """
+        ys = np.flatnonzero(solid.any(axis=1))
+        xs = np.flatnonzero(solid.any(axis=0))
+        if len(ys) == 0:
+            return cls(left, bottom, 0, [])
+        solid = solid[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1]
+        packed = np.packbits(solid, axis=1, bitorder='little')
+        rows = [int.from_bytes(row.tobytes(), 'little') for row in packed]
+        return cls(left + int(xs[0]), bottom + int(ys[0]), solid.shape[1], rows)
+
+    def corner(self, pos):
+        return _round(pos[0] + self.left), _round(pos[1] + self.bottom)
+
+    def overlaps(self, pos, other, otherPos):
+        """
+        Whether this mask centered at pos shares a pixel with other centered
+        at otherPos.
+        """
+        ax, ay = self.corner(pos)
+        bx, by = other.corner(otherPos)
+        dx = bx - ax
+        dy = by - ay
+        if dx >= self.width or -dx >= other.width:
+            return False
+        rows = self.rows
+        otherRows = other.rows
+        start = max(0, dy)
+        stop = min(len(rows), dy + len(otherRows))
+        if dx >= 0:
+            for j in range(start, stop):
+                if rows[j] & (otherRows[j - dy] << dx):
+                    return True
+        else:
+            for j in range(start, stop):
+                if (rows[j] << -dx) & otherRows[j - dy]:
+                    return True
+        return False
+
+
+def rotate(solid, angle):
+    """
+    Rasterize the (height, width) bool array solid, centered at the origin
+    and rotated by angle, with nearest neighbour sampling the way the sprite
+    shader does. Return (rotated, left, bottom).
+    """
+    h, w = solid.shape
+    c = math.cos(angle)
+    s = math.sin(angle)
+    # Keep the parity of the sprite size, so the sampling lattice matches
+    # the texels at angle 0
+    W = math.ceil(abs(w * c) + abs(h * s))
+    W += (W - w) % 2
+    H = math.ceil(abs(w * s) + abs(h * c))
+    H += (H - h) % 2
+    u = np.arange(W) + .5 - W / 2
+    v = np.arange(H) + .5 - H / 2
+    u, v = np.meshgrid(u, v)
+    cols = np.floor(c * u + s * v + w / 2).astype(np.intp)
+    rows = np.floor(-s * u + c * v + h / 2).astype(np.intp)
+    inside = (cols >= 0) & (cols < w) & (rows >= 0) & (rows < h)
+    rotated = np.zeros((H, W), dtype=bool)
+    rotated[inside] = solid[rows[inside], cols[inside]]
+    return rotated, -W / 2, -H / 2
+
+
+class CollisionMasks:
+    """
+    Masks of every atlas entry, taken from the alpha channel of texture.png.
+    The bird's frames are pre-rotated over config.maskAngles angles from
+    straight down to Bird.MAX_ANGLE, so a test never rotates anything.
+    """
+    MIN_ANGLE = -math.pi / 2
+
+    def __init__(self, masks):
+        # {maskColor: [Mask]}, one mask per angle for rotated entries
+        self._masks = masks
+        self._angleStep = (Bird.MAX_ANGLE - self.MIN_ANGLE) / (config.maskAngles - 1)
+
+    @classmethod
+    def cache_key(cls):
+        digest = hashlib.sha1()
+        for name in ('texture.png', 'spritemask.png'):
+            with open(get_resource_path('images', name), 'rb') as infile:
+                digest.update(infile.read())
+        digest.update(repr((
+            ALPHA_THRESHOLD, config.maskAngles, cls.MIN_ANGLE, Bird.MAX_ANGLE,
+            Bird.maskColors)).encode())
+        return np.array(digest.hexdigest())
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Load the masks from the cache, building and storing them when missing
+        or built from different images.
+        """
+        if path is None:
+            path = os.path.join(config.cacheDir, 'masks.npz')
+        key = cls.cache_key()
+        if os.path.exists(path):
+            with np.load(path) as data:
+                if np.array_equal(data['key'], key):
+                    return cls(cls._unpack(data['meta'], data['bits']))
+        masks = cls.build()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez_compressed(path, key=key, **cls._pack(masks))
+        return cls(masks)
+
+    @classmethod
+    def build(cls):
+        boxes, (w, h) = atlas_boxes()
+        image = Image.open(get_resource_path('images', 'texture.png'))
+        alpha = np.asarray(image.convert('RGBA'))[:, :, 3]
+        angles = np.linspace(cls.MIN_ANGLE, Bird.MAX_ANGLE, config.maskAngles)
+        masks = {}
+        for color, (x0, y0, x1, y1) in boxes.items():
+            solid = alpha[h - y1:h - y0, x0:x1][::-1] >= ALPHA_THRESHOLD
+            if color in Bird.maskColors:
+                masks[color] = [
+                    Mask.from_array(*rotate(solid, angle)) for angle in angles]
+            else:
+                masks[color] = [
+                    Mask.from_array(solid, -(x1 - x0) / 2, -(y1 - y0) / 2)]
+        return masks
+
+    @staticmethod
+    def _pack(masks):
+        meta = []
+        bits = []
+        for (r, g, b), colorMasks in masks.items():
+            for i, mask in enumerate(colorMasks):
+                nBytes = (mask.width + 7) // 8
+                meta.append((
+                    r, g, b, i, round(mask.left * 2), round(mask.bottom * 2),
+                    mask.width, len(mask.rows)))
+                for row in mask.rows:
+                    bits.append(row.to_bytes(nBytes, 'little'))
+        return {
+            'meta': np.array(meta, dtype=np.int32).reshape(-1, 8),
+            'bits': np.frombuffer(b''.join(bits), dtype=np.uint8),
+        }
+
+    @staticmethod
+    def _unpack(meta, bits):
+        bits = bits.tobytes()
+        masks = {}
+        offset = 0
+        for r, g, b, _, left2, bottom2, width, height in meta.tolist():
+            nBytes = (width + 7) // 8
+            rows = []
+            for _ in range(height):
+                rows.append(int.from_bytes(bits[offset:offset + nBytes], 'little'))
+                offset += nBytes
+            masks.setdefault((r, g, b), []).append(
+                Mask(left2 / 2, bottom2 / 2, width, rows))
+        return masks
+
+    def angle_index(self, angle):
+        i = _round((angle - self.MIN_ANGLE) / self._angleStep)
+        return min(max(i, 0), config.maskAngles - 1)
+
+    def masks_of(self, maskColor):
+        "The masks of an atlas entry, one per angle for rotated entries."
+        return self._masks[maskColor]
+
+    def mask(self, sprite):
+        masks = self._masks[sprite.maskColor]
+        if len(masks) == 1:
+            return masks[0]
+        return masks[self.angle_index(sprite.angle)]
+
+    def hit(self, sprite, other):
+        """
+        Whether the visible pixels of two sprites overlap.
+        """
+        return self.mask(sprite).overlaps(
+            sprite.screenPos, self.mask(other), other.screenPos)
@@ -1,5 +1,7 @@
+import os
 FPS = 48
 caption = 'Flappy Bird'
+cacheDir = os.path.join(os.path.expanduser('~'), '.cache', 'flappybird')
 pillarWidth = 26
 lowerPillarHeight = 121
 upperPillarHeight = 135
@@ -7,6 +9,20 @@ notchHeight = 50
 notchCenterRange = -20, 40
 floorY = -75
 zoom = 3
+# Frame scheduling, see scheduler.py
+vsync = False
+# Stalls longer than this, in seconds, are not caught up on
+maxFrameLag = .25
+# Updates run back to back at most before events and drawing get a turn
+maxCatchUpUpdates = 5
+# Draws skipped in a row at most while behind
+maxSkippedDraws = 4
+# Presented frames the pacing statistics cover
+statsWindow = 240
+# How the native resolution scene is upscaled into the window:
+# 'integer', 'fit' (letterboxed) or 'stretch'
+scaleMode = 'integer'
+letterboxColor = (0., 0., 0., 1.)
 screenHeight = 256
 screenWidth = 144
 gapWidth = screenWidth / 2
@@ -21,3 +37,34 @@ beginDistance = 200
 scrollDistancePerFrame = 1
 gravity = 0.30
 nPillars = 3
+# Pre-rotated collision masks of the bird, see collision.py
+maskAngles = 64
+maxParticles = 65536
+dustInterval = 6
+# Recorded runs shown as ghosts, see ghosts.save_runs. None disables them.
+ghostFile = None
+ghostCount = 5000
+ghostAlpha = 0.3
+# Finished runs are added to this file on exit, see ghosts.append_runs
+ghostRecordFile = None
+# Let the built-in autopilot play, toggled with the A key
+autopilot = False
+# Spectator streaming, see stream.py. streamPort None disables the server.
+streamHost = '127.0.0.1'
+streamPort = None
+# Snapshots per second, a divisor of FPS
+streamRate = 24
+# Deltas larger than this start a new keyframe
+streamKeyBytes = 12
+# Bytes queued for a viewer beyond which its frames are dropped
+streamMaxBacklog = 4096
+# Seconds a spectator waits before connecting again
+streamRetryDelay = 1.
+# Watch the stream at streamHost:streamPort instead of playing
+spectate = False
+# Training data recording, see dataset.py. recordDir None disables it.
+recordDir = None
+# Also store the rendered frame of each record
+recordImages = False
+shardBytes = 256 << 20
+recorderThreads = 2
@@ -0,0 +1,257 @@
+import json
+import os
+import queue
+import threading
+import numpy as np
+from . import config
+from .game import GameState
+
+# bird y, bird vy, bird angle, flap impulse left, then dx and dy of the next
+# two pillars' notches
+STATE_SIZE = 8
+INDEX_FILE = 'index.json'
+
+
+def fill_state(game, out):
+    """
+    Write the compact state of game into the float32 vector out.
+    """
+    bird = game.bird
+    birdX, birdY = bird.screenPos
+    out[0] = birdY
+    out[1] = bird.speed[1]
+    out[2] = bird.angle
+    out[3] = bird._flapGainColdDown
+    pillars = sorted(
+        (pillar.x - game._viewX - birdX, pillar.offset)
+        for pillar in game.upperPillars
+        if pillar.x - game._viewX - birdX + config.pillarWidth / 2 >= 0)
+    for i in range(2):
+        dx, offset = pillars[i] if i < len(pillars) else (0., 0.)
+        out[4 + 2 * i] = dx
+        out[5 + 2 * i] = birdY - offset
+
+
+def record_fields(imageShape=None):
+    """
+    Return [(name, dtype, shape)] of a record. Each field is stored in its own
+    file per shard, so readers only map the fields they use.
+    """
+    fields = [
+        ('frame', np.int64, ()),
+        ('state', np.float32, (STATE_SIZE,)),
+        ('action', np.uint8, ()),
+        ('reward', np.float32, ()),
+        ('done', np.bool_, ()),
+    ]
+    if imageShape is not None:
+        fields.append(('image', np.uint8, tuple(imageShape)))
+    return fields
+
+
+def shard_path(directory, name, shard):
+    return os.path.join(directory, '{}-{:05d}.npy'.format(name, shard))
+
+
+class _Shard:
+    def __init__(self, directory, number, fields, rows):
+        self.number = number
+        self.count = 0
+        self.arrays = {
+            name: np.lib.format.open_memmap(
+                shard_path(directory, name, number), mode='w+',
+                dtype=dtype, shape=(rows,) + shape)
+            for name, dtype, shape in fields
+        }
+
+
+class Recorder:
+    """
+    Streams records into fixed size, memory mapped .npy shards.
+    Records are written in place into the mapped shard files, there is no
+    intermediate buffer to copy from. Finished shards are flushed to disk
+    and added to the index by a bounded pool of writer threads; when they
+    fall behind, record() waits for a free slot instead of piling up memory.
+    """
+    def __init__(self, directory, imageShape=None,
+                 shardBytes=config.shardBytes, threads=config.recorderThreads):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fields = record_fields(imageShape)
+        rowBytes = sum(
+            np.dtype(dtype).itemsize * int(np.prod(shape))
+            for _, dtype, shape in self.fields)
+        self.shardRows = max(1, shardBytes // rowBytes)
+        self._shard = None
+        self._nextShard = 0
+        self._finished = []
+        self._indexLock = threading.Lock()
+        self._jobs = queue.Queue(maxsize=threads)
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+        # Episode bookkeeping of record_game, (game, runId) of the last run
+        self._game = None
+        self._gameFrame = 0
+        self._gameDone = False
+        self.imagePending = False
+
+    def __len__(self):
+        return sum(count for _, count in self._finished)\
+            + (self._shard.count if self._shard else 0)
+
+    def _work(self):
+        while True:
+            shard = self._jobs.get()
+            if shard is None:
+                return
+            for array in shard.arrays.values():
+                array.flush()
+            with self._indexLock:
+                self._finished.append((shard.number, shard.count))
+                self._write_index()
+            del shard.arrays
+            self._jobs.task_done()
+
+    def _write_index(self):
+        index = {
+            'fields': [
+                (name, np.dtype(dtype).str, list(shape))
+                for name, dtype, shape in self.fields],
+            'shardRows': self.shardRows,
+            'shards': sorted(self._finished),
+        }
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(path + '.tmp', 'w') as outfile:
+            json.dump(index, outfile)
+        os.replace(path + '.tmp', path)
+
+    def _row(self):
+        if self._shard is None or self._shard.count == self.shardRows:
+            if self._shard is not None:
+                self._jobs.put(self._shard)
+            self._shard = _Shard(
+                self.directory, self._nextShard, self.fields, self.shardRows)
+            self._nextShard += 1
+        row = self._shard.count
+        self._shard.count += 1
+        return row
+
+    def record(self, frame, state, action, reward, done, image=None):
+        row = self._row()
+        arrays = self._shard.arrays
+        arrays['frame'][row] = frame
+        arrays['state'][row] = state
+        arrays['action'][row] = action
+        arrays['reward'][row] = reward
+        arrays['done'][row] = done
+        if image is not None:
+            arrays['image'][row] = image
+        return row
+
+    def record_game(self, game):
+        """
+        Record the frame of a game that has just been updated: one record per
+        frame from the start of a run to the frame it ends on. The state
+        vector is filled directly in the shard.
+        action is whether a flap took effect during the update that produced
+        state, not the action taken from state: that one is the action of
+        the next record.
+        """
+        if game.state == GameState.ready:
+            return
+        run = (game, game.runId)
+        if run != self._game:
+            self._game = run
+            self._gameFrame = 0
+            self._gameDone = False
+        if self._gameDone:
+            return
+        done = game.state not in (GameState.entering, GameState.flyying)
+        self._gameDone = done
+        row = self._row()
+        arrays = self._shard.arrays
+        arrays['frame'][row] = self._gameFrame
+        fill_state(game, arrays['state'][row])
+        arrays['action'][row] = game.lastAction
+        arrays['reward'][row] = 0. if done else 1.
+        arrays['done'][row] = done
+        self._gameFrame += 1
+        self.imagePending = 'image' in arrays
+
+    def last_image(self):
+        """
+        The image slot of the latest record, to be filled in place with the
+        frame rendered from its state.
+        """
+        self.imagePending = False
+        return self._shard.arrays['image'][self._shard.count - 1]
+
+    def close(self):
+        if self._shard is not None and self._shard.count:
+            self._jobs.put(self._shard)
+        self._shard = None
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class Dataset:
+    """
+    Read side of Recorder. Shards are memory mapped on first use, so slicing
+    only touches the pages actually read.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILE)) as infile:
+            index = json.load(infile)
+        self.fields = [name for name, _, _ in index['fields']]
+        self._shards = [tuple(shard) for shard in index['shards']]
+        counts = [count for _, count in self._shards]
+        self._offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self._maps = {}
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def shard(self, i, name):
+        """
+        Memory mapped field of the i-th shard, trimmed to its records.
+        """
+        key = (i, name)
+        if key not in self._maps:
+            number, count = self._shards[i]
+            self._maps[key] = np.load(
+                shard_path(self.directory, name, number), mmap_mode='r')[:count]
+        return self._maps[key]
+
+    def get(self, name, index):
+        """
+        Records of one field by position or slice (step 1). A slice within a
+        shard is a view of the mapped file.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('Only contiguous slices are supported')
+            if stop <= start:
+                return self.shard(0, name)[:0]
+            first = int(np.searchsorted(self._offsets, start, side='right')) - 1
+            last = int(np.searchsorted(self._offsets, stop - 1, side='right')) - 1
+            parts = [
+                self.shard(i, name)[
+                    max(start - self._offsets[i], 0):stop - self._offsets[i]]
+                for i in range(first, last + 1)]
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        i = int(np.searchsorted(self._offsets, index, side='right')) - 1
+        return self.shard(i, name)[index - self._offsets[i]]
+
+    def __getitem__(self, index):
+        return {name: self.get(name, index) for name in self.fields}
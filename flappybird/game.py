@@ -2,6 +2,7 @@ import random
 import pyglet
 from . import sprites
 from .bird import Bird
+from .particles import ParticleSystem, Feather, Dust, Sparkle
 from . import ui
 from . import config
 
@@ -16,10 +17,31 @@ class GameState:
 
 class Context:
     sprites = []
+    # Objects drawn after sprites with a draw(render) method
+    batches = []
 
     def __init__(self, app):
         self.app = app
 
+    def reset(self):
+        """
+        Return to the state of a new context, so App can reuse this one.
+        Contexts that are cheap to build just build themselves again.
+        """
+        self.__init__(self.app)
+
+    def on_enter(self):
+        """
+        Called when this context becomes the current one.
+        """
+        pass
+
+    def next_context(self):
+        """
+        The context class most likely to follow, which App prepares ahead.
+        """
+        return None
+
     def __repr__(self):
         return '{}()'.format(self.__class__.__name__)
 
@@ -57,6 +79,9 @@ class Menu(Context):
 
         self.sprites = [background, startButton, scoreButton]
 
+    def next_context(self):
+        return Game
+
     def start(self):
         self.switch_to_context(Game)
 
@@ -71,25 +96,63 @@ class ScoreBoard(Context):
 class Game(Context):
     def __init__(self, app):
         super().__init__(app)
-        self.state = GameState.ready
         self.bird = Bird()
         self.upperPillars = [sprites.UpperPillar() for _ in range(config.nPillars)]
         self.lowerPillars = [sprites.LowerPillar() for _ in range(config.nPillars)]
-        self.put_pillars()
         background = sprites.Background()
         self.floor = sprites.Floor()
         self.tapToStart = tapToStart = sprites.TapToStart()
         tapToStart.on_click = self.start
-        self.sprites = [background] + self.upperPillars + self.lowerPillars\
+        self._allSprites = [background] + self.upperPillars + self.lowerPillars\
             + [self.bird, self.floor, tapToStart]
+        self.masks = app.collisionMasks
+        self.obstacles = self.upperPillars + self.lowerPillars + [self.floor]
+        self.particles = ParticleSystem()
+        self.batches = [self.particles]
+        self.ghosts = app.ghosts
+        if self.ghosts is not None:
+            self.batches.insert(0, self.ghosts)
+        # Counts the runs played with this context
+        self.runId = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new run in place, reusing every sprite and buffer.
+        """
+        self.state = GameState.ready
+        self.runId += 1
+        self.bird.reset()
+        self.put_pillars()
+        self.floor.moving = True
+        tapToStart = self.tapToStart
+        tapToStart.alpha = 1.
+        tapToStart.effects = []
+        tapToStart._needRemove = False
+        self.sprites = list(self._allSprites)
+        self.particles.clear()
+        # Bird heights since the run started, kept in app.ghostRuns on a hit
+        self.trajectory = []
+        # Whether a flap took effect since the last update, and in the last
+        # update, which is what dataset.Recorder stores as the action
+        self.flapped = False
+        self.lastAction = False
         self._viewX = 0
         self.score = 0
 
+    def on_enter(self):
+        if self.ghosts is not None:
+            self.ghosts.rewind()
+
+    def next_context(self):
+        # Quick retries: a new run follows most runs
+        return Game
+
     def start(self):
         self.state = GameState.entering
         self.tapToStart.fade_out(self.tapToStart.mark_to_remove)
         self.bird.started = True
-        self.bird.flap()
+        self.flapped = self.bird.flap()
 
     def get_notch_offset(self):
         return random.randint(*config.notchCenterRange)
@@ -102,13 +165,34 @@ class Game(Context):
             pillar.offset = pillar1.offset = self.get_notch_offset()
 
     def hit(self):
+        if self.app.ghostRuns is not None:
+            self.app.ghostRuns.append(self.trajectory)
+        self.state = GameState.falling
         self.floor.moving = False
         self.bird.on_hit()
+        self.particles.emit(Feather, 40, self.bird.screenPos)
+
+    def collides(self):
+        masks = self.masks
+        return any(masks.hit(self.bird, sprite) for sprite in self.obstacles)
 
     def add_score(self):
         self.score += 1
+        self.particles.emit(Sparkle, 24, self.bird.screenPos)
 
     def update(self, dt):
+        autopilot = self.app.autopilot
+        if self.app.autopilotEnabled:
+            if self.state == GameState.ready:
+                self.start()
+            elif self.state in (GameState.entering, GameState.flyying)\
+                    and autopilot.control(self):
+                self.flapped = self.bird.flap() or self.flapped
+            elif self.state == GameState.falling\
+                    and self.bird.screenPos[1] < config.floorY:
+                # Start over once the bird is down, for unattended runs
+                self.switch_to_context(Game)
+
         for i in range(config.nPillars):
             pillar = self.upperPillars[i]
             pillar1 = self.lowerPillars[i]
@@ -123,8 +207,28 @@ class Game(Context):
 
         if self.state in (GameState.entering, GameState.flyying):
             self._viewX += config.scrollDistancePerFrame
-
+            # Score once a pillar's center has passed the bird
+            birdX = self.bird.screenPos[0]
+            for pillar in self.upperPillars:
+                x = pillar.x - self._viewX
+                if x < birdX <= x + config.scrollDistancePerFrame:
+                    self.add_score()
+            self.particles.scroll(-config.scrollDistancePerFrame)
+            if self._viewX % config.dustInterval == 0:
+                self.particles.emit(
+                    Dust, 2, (self.bird.screenPos[0], config.floorY))
+
+        self.particles.update(dt)
         super().update(dt)
+        if self.state in (GameState.entering, GameState.flyying)\
+                and self.collides():
+            self.hit()
+        if self.state in (GameState.entering, GameState.flyying):
+            self.trajectory.append(float(self.bird.screenPos[1]))
+            if self.ghosts is not None:
+                self.ghosts.update(dt)
+        self.lastAction = self.flapped
+        self.flapped = False
 
     def on_key_press(self, key, modifiers):
         if key == pyglet.window.key.SPACE:
@@ -137,4 +241,6 @@ class Game(Context):
         if self.state == GameState.ready:
             self.start()
         elif self.state in (GameState.entering, GameState.flyying):
-            self.bird.flap()
+            self.flapped = self.bird.flap() or self.flapped
+        elif self.state in (GameState.falling, GameState.showboard):
+            self.switch_to_context(Game)
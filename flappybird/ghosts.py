@@ -0,0 +1,119 @@
+import os
+import numpy as np
+from . import gllib as gl
+from . import config
+from .bird import Bird
+
+
+def save_runs(path, trajectories, scores=None):
+    """
+    Store recorded runs for ghost races.
+    trajectories: A list of per-frame bird heights, one sequence per run.
+    scores: Optional per-run ranking values, run length is used by default.
+    """
+    lengths = np.array([len(t) for t in trajectories], dtype=np.int32)
+    ys = np.zeros((len(trajectories), max(lengths, default=0)), dtype=np.float32)
+    for i, t in enumerate(trajectories):
+        ys[i, :len(t)] = t
+    if scores is None:
+        scores = lengths
+    np.savez_compressed(
+        path, ys=ys, lengths=lengths, scores=np.asarray(scores))
+
+
+def append_runs(path, trajectories):
+    """
+    Add runs to the file at path, creating it if needed. Runs are ranked by
+    their length.
+    """
+    trajectories = list(trajectories)
+    # np.savez_compressed adds the extension, look for the file it writes
+    if not path.endswith('.npz'):
+        path += '.npz'
+    if os.path.exists(path):
+        with np.load(path) as data:
+            ys, lengths = data['ys'], data['lengths']
+        trajectories = [ys[i, :n] for i, n in enumerate(lengths)] + trajectories
+    save_runs(path, trajectories)
+
+
+class GhostRace:
+    """
+    Replays many recorded runs as translucent birds in one draw call.
+    Runs are sorted by length, so the ghosts still flying at any tick are a
+    prefix of the per-tick row and all per-frame work is a handful of vector
+    operations.
+    """
+    def __init__(self, ys, lengths, alpha=config.ghostAlpha):
+        """
+        ys: (nRuns, nFrames) bird heights, padded past each run's length
+        lengths: (nRuns,) number of recorded frames of each run
+        """
+        order = np.argsort(-lengths, kind='stable')
+        lengths = lengths[order]
+        ys = ys[order]
+        nRuns, nFrames = ys.shape
+        # Frame major, with the last height repeated once so a vertical speed
+        # is defined on every recorded frame.
+        self._ys = np.empty((nFrames + 1, nRuns), dtype=gl.GLfloat)
+        self._ys[:nFrames] = ys.T
+        self._ys[nFrames] = self._ys[nFrames - 1] if nFrames else 0
+        self._negLengths = -lengths
+        self._phase = np.arange(nRuns) % len(Bird.maskColors)
+        self.sprite = np.zeros((nRuns, 4), dtype=gl.GLfloat)
+        self.sprite[:, 0] = config.birdInitPos[0]
+        self.alpha = np.full(nRuns, alpha, dtype=gl.GLfloat)
+        self._atlasIds = None
+        self.tick = 0
+
+    def __len__(self):
+        return len(self.sprite)
+
+    @classmethod
+    def load(cls, path, best=config.ghostCount):
+        """
+        Load the best runs stored by save_runs.
+        """
+        with np.load(path) as data:
+            ys, lengths, scores = data['ys'], data['lengths'], data['scores']
+        keep = np.argsort(-scores, kind='stable')[:best]
+        return cls(ys[keep], lengths[keep])
+
+    def rewind(self):
+        self.tick = 0
+
+    def update(self, dt):
+        self.tick += 1
+
+    @property
+    def frame(self):
+        """
+        Recorded frame shown at the current tick. After n updates the live
+        bird is at trajectory index n - 1, the ghosts are drawn there too.
+        """
+        return max(self.tick - 1, 0)
+
+    def active_count(self):
+        "Number of ghosts whose run reaches the shown frame."
+        return int(np.searchsorted(self._negLengths, -self.frame, side='left'))
+
+    def draw(self, render):
+        if self._atlasIds is None:
+            self._atlasIds = render.atlas_ids(Bird.maskColors)
+        n = self.active_count()
+        if n == 0:
+            return
+        t = self.frame
+        ys = self._ys[t, :n]
+        vy = self._ys[t + 1, :n] - ys
+        sprite = self.sprite[:n]
+        sprite[:, 1] = ys
+        angles = np.minimum(
+            Bird.MAX_ANGLE, np.arctan2(vy, config.scrollDistancePerFrame))
+        sprite[:, 2] = angles
+        # Same cadence as Bird.update: wings flap while rising, stay put
+        # while diving.
+        frames = (t // (config.FPS // 12) + self._phase[:n]) % len(Bird.maskColors)
+        frames[angles < 0] = 1
+        sprite[:, 3] = self._atlasIds[frames]
+        render.draw_batch(sprite, self.alpha[:n])
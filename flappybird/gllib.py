@@ -4,7 +4,8 @@ from OpenGL.GL import *
 __all__ = [
     'compile_shader', 'report_limits', 'AttributeNotFoundError',
     'UniformNotFoundError', 'VertexBuffer', 'IndexBuffer', 'Program',
-    'Texture2D', 'TextureUnit', 'VertexBufferSlot'
+    'Texture2D', 'TextureUnit', 'VertexBufferSlot', 'Framebuffer',
+    'FramebufferIncompleteError', 'GLState', 'state',
 ]
 
 
@@ -30,6 +31,180 @@ class AttributeNotFoundError(Exception):
 class UniformNotFoundError(Exception):
     pass
 
+class FramebufferIncompleteError(Exception):
+    pass
+
+class GLState:
+    """
+    Shadow copy of the GL state this package changes. Every call goes through
+    here, so the ones that would leave the state as it is are skipped. In
+    PyOpenGL the call overhead dominates, so skipped calls are the point.
+    Counts issued and skipped calls, end_frame() closes a frame.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.skipped = 0
+        # (calls, skipped) of the last finished frame
+        self.lastFrame = (0, 0)
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the cached state. Needed whenever GL state was changed
+        behind the tracker's back, or an object it may refer to was deleted.
+        """
+        self._program = None
+        self._vao = None
+        self._buffers = {}
+        self._attribPointers = {}
+        self._activeTexture = None
+        self._textures = {}
+        self._uniforms = {}
+        self._framebuffer = None
+        self._capabilities = {}
+        self._viewport = None
+        self._clearColor = None
+        self._blendFunc = None
+        self._pixelStore = {}
+
+    def end_frame(self):
+        self.lastFrame = (self.calls, self.skipped)
+        self.calls = self.skipped = 0
+        return self.lastFrame
+
+    def _changed(self, cache, key, value):
+        if key in cache and cache[key] == value:
+            self.skipped += 1
+            return False
+        cache[key] = value
+        self.calls += 1
+        return True
+
+    def use_program(self, id):
+        if self._program == id:
+            self.skipped += 1
+            return
+        self._program = id
+        self.calls += 1
+        glUseProgram(id)
+
+    def bind_vertex_array(self, id):
+        if self._vao == id:
+            self.skipped += 1
+            return
+        self._vao = id
+        self.calls += 1
+        glBindVertexArray(id)
+
+    def bind_buffer(self, target, id):
+        # The element array binding belongs to the bound VAO
+        key = (target, self._vao) if target == GL_ELEMENT_ARRAY_BUFFER else target
+        if self._changed(self._buffers, key, id):
+            glBindBuffer(target, id)
+
+    def bind_framebuffer(self, id):
+        if self._framebuffer == id:
+            self.skipped += 1
+            return
+        self._framebuffer = id
+        self.calls += 1
+        glBindFramebuffer(GL_FRAMEBUFFER, id)
+
+    def attrib_pointer(self, location, buffer, size, type):
+        """
+        Point an attribute of the bound VAO at buffer. The pointer is part of
+        the VAO, so it only has to be set again for a different buffer.
+        """
+        key = (self._vao, location)
+        if self._changed(self._attribPointers, key, (buffer, size, type)):
+            self.bind_buffer(GL_ARRAY_BUFFER, buffer)
+            glVertexAttribPointer(location, size, type, GL_FALSE, 0, None)
+
+    def active_texture(self, unit):
+        if self._activeTexture == unit:
+            self.skipped += 1
+            return
+        self._activeTexture = unit
+        self.calls += 1
+        glActiveTexture(unit)
+
+    def bind_texture(self, target, id):
+        "Bind a texture to the active texture unit."
+        if self._changed(self._textures, (self._activeTexture, target), id):
+            glBindTexture(target, id)
+
+    def uniform(self, setter, location, *args):
+        """
+        Set a uniform of the program in use, unless it already has this value.
+        setter: e.g. glUniform1i or glUniform4fv
+        """
+        value = tuple(
+            arg.tobytes() if hasattr(arg, 'tobytes') else arg for arg in args)
+        if self._changed(self._uniforms, (self._program, location), value):
+            setter(location, *args)
+
+    def enable(self, capability):
+        if self._changed(self._capabilities, capability, True):
+            glEnable(capability)
+
+    def disable(self, capability):
+        if self._changed(self._capabilities, capability, False):
+            glDisable(capability)
+
+    def viewport(self, x, y, w, h):
+        if self._viewport == (x, y, w, h):
+            self.skipped += 1
+            return
+        self._viewport = (x, y, w, h)
+        self.calls += 1
+        glViewport(x, y, w, h)
+
+    def clear_color(self, r, g, b, a):
+        if self._clearColor == (r, g, b, a):
+            self.skipped += 1
+            return
+        self._clearColor = (r, g, b, a)
+        self.calls += 1
+        glClearColor(r, g, b, a)
+
+    def blend_func(self, src, dst):
+        if self._blendFunc == (src, dst):
+            self.skipped += 1
+            return
+        self._blendFunc = (src, dst)
+        self.calls += 1
+        glBlendFunc(src, dst)
+
+    def pixel_store(self, name, value):
+        if self._changed(self._pixelStore, name, value):
+            glPixelStorei(name, value)
+
+    def tex_parameter(self, target, name, value):
+        "Set a parameter of the texture bound to target."
+        self.calls += 1
+        glTexParameteri(target, name, value)
+
+    def buffer_data(self, target, data, usage):
+        "Upload data to the buffer bound to target."
+        self.calls += 1
+        glBufferData(target, data, usage)
+
+    def clear(self, mask=GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT):
+        self.calls += 1
+        glClear(mask)
+
+    def read_pixels(self, x, y, width, height, format, type, out):
+        self.calls += 1
+        glReadPixels(x, y, width, height, format, type, array=out)
+
+    def draw_arrays(self, primitive_type, first, count):
+        self.calls += 1
+        glDrawArrays(primitive_type, first, count)
+
+
+state = GLState()
+
+
 class GLResource:
     def __init__(self):
         self._id = None
@@ -52,6 +227,8 @@ class GLResource:
             return
         self.dealloc()
         self._id = None
+        # GL unbinds deleted objects and may hand their ids out again
+        state.reset()
 
     def __del__(self):
         if self._id is not None:
@@ -69,15 +246,15 @@ class Texture2D(GLResource):
     def allocate(self):
         textureId = self.make_texture(self.image)
         del self.image
-        glBindTexture(GL_TEXTURE_2D, textureId)
+        state.bind_texture(GL_TEXTURE_2D, textureId)
         self.configure()
         return textureId
 
     def configure(self):
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, self.MAG_FILTER)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, self.MIN_FILTER)
+        state.tex_parameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+        state.tex_parameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
+        state.tex_parameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, self.MAG_FILTER)
+        state.tex_parameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, self.MIN_FILTER)
         glGenerateMipmap(GL_TEXTURE_2D)
 
     def dealloc(self):
@@ -87,9 +264,9 @@ class Texture2D(GLResource):
     def make_texture(image):
         data = image.convert('RGBA').tobytes()
         width, height = image.size
-        glEnable(GL_TEXTURE_2D)
+        state.enable(GL_TEXTURE_2D)
         textureId = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D, textureId)
+        state.bind_texture(GL_TEXTURE_2D, textureId)
         assert textureId > 0, 'Fail to get new texture id.'
         glTexImage2D(
             GL_TEXTURE_2D, 0,
@@ -103,6 +280,72 @@ class Texture2D(GLResource):
         return textureId
 
 
+class Framebuffer(GLResource):
+    """
+    An offscreen render target backed by a single RGBA color texture.
+    """
+    FILTER = GL_NEAREST
+
+    def __init__(self, width, height):
+        GLResource.__init__(self)
+        self.size = (width, height)
+        self.texture = None
+
+    def allocate(self):
+        width, height = self.size
+        self.texture = glGenTextures(1)
+        state.bind_texture(GL_TEXTURE_2D, self.texture)
+        glTexImage2D(
+            GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0,
+            GL_RGBA, GL_UNSIGNED_BYTE, None)
+        state.tex_parameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        state.tex_parameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        state.tex_parameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, self.FILTER)
+        state.tex_parameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, self.FILTER)
+
+        id = glGenFramebuffers(1)
+        state.bind_framebuffer(id)
+        glFramebufferTexture2D(
+            GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texture, 0)
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        state.bind_framebuffer(0)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            glDeleteFramebuffers(1, [id])
+            glDeleteTextures([self.texture])
+            self.texture = None
+            state.reset()
+            raise FramebufferIncompleteError(status)
+        return id
+
+    def dealloc(self):
+        glDeleteFramebuffers(1, [self._id])
+        glDeleteTextures([self.texture])
+        self.texture = None
+
+    @contextmanager
+    def bind(self):
+        """
+        Redirect drawing into this target. The caller restores the window
+        viewport afterwards.
+        """
+        state.bind_framebuffer(self.glId)
+        state.viewport(0, 0, *self.size)
+        yield
+        state.bind_framebuffer(0)
+
+    def read_pixels(self, out):
+        """
+        Read the color buffer into out, a C contiguous uint8 array of shape
+        (height, width, 3). Rows are bottom to top, as GL stores them.
+        """
+        width, height = self.size
+        state.bind_framebuffer(self.glId)
+        state.pixel_store(GL_PACK_ALIGNMENT, 1)
+        state.read_pixels(0, 0, width, height, GL_RGB, GL_UNSIGNED_BYTE, out)
+        state.bind_framebuffer(0)
+        return out
+
+
 class VertexBuffer(GLResource):
     target = GL_ARRAY_BUFFER
 
@@ -120,8 +363,8 @@ class VertexBuffer(GLResource):
         id = glGenBuffers(1)
         data = self.data
         del self.data
-        glBindBuffer(self.target, id)
-        glBufferData(self.target, data, self.usageHint)
+        state.bind_buffer(self.target, id)
+        state.buffer_data(self.target, data, self.usageHint)
         return id
 
     def dealloc(self):
@@ -142,9 +385,8 @@ class VertexBufferSlot:
         self.dataType = data_type
 
     def set_buffer(self, buffer):
-        glBindBuffer(GL_ARRAY_BUFFER, buffer.glId)
-        glVertexAttribPointer(
-            self.location, self.itemSize, self.dataType, GL_FALSE, 0, None)
+        state.attrib_pointer(
+            self.location, buffer.glId, self.itemSize, self.dataType)
 
 
 class Program(GLResource):
@@ -180,16 +422,17 @@ class Program(GLResource):
         # Make VAO
         self._buffers = {}
         self.vao = glGenVertexArrays(1)
-        glBindVertexArray(self.vao)
+        state.bind_vertex_array(self.vao)
 
-        # Make buffer slots
+        # Make buffer slots. Enabled attributes are part of the VAO state, so
+        # they are enabled once here.
         for name, size, type in self.bufs:
             loc = glGetAttribLocation(id, name.encode('ascii'))
             if loc < 0:
                 raise AttributeNotFoundError(name)
             self._buffers[name] = VertexBufferSlot(loc, size, type)
+        self.enable_attribs()
 
-        glUseProgram(0)
         del self.bufs, self.shaderDatas
         return self.id
 
@@ -203,14 +446,13 @@ class Program(GLResource):
 
     @contextmanager
     def batch_draw(self):
+        # The program and VAO stay bound afterwards, the next batch_draw
+        # skips rebinding them when nothing else was used in between.
         self.use()
-        glBindVertexArray(self.vao)
-        self.enable_attribs()
+        state.bind_vertex_array(self.vao)
         self.prepare_draw()
         yield
         self.post_draw()
-        self.disable_attribs()
-        self.unuse()
 
     def prepare_draw(self):
         pass
@@ -227,7 +469,10 @@ class Program(GLResource):
             glDisableVertexAttribArray(buf.location)
 
     def draw(self, primitive_type, count):
-        glDrawArrays(primitive_type, 0, count)
+        state.draw_arrays(primitive_type, 0, count)
+
+    def set_uniform(self, name, setter, *args):
+        state.uniform(setter, self.get_uniform_loc(name), *args)
 
     def get_uniform_loc(self, name):
         if name not in self._ulocs:
@@ -270,13 +515,13 @@ class Program(GLResource):
         return True
 
     def use(self):
-        glUseProgram(self.glId)
+        state.use_program(self.glId)
 
     def unuse(self):
-        glUseProgram(0)
+        state.use_program(0)
 
     def set_matrix(self, name, mat):
-        glUniformMatrix4fv(self.get_uniform_loc(name), 1, GL_TRUE, mat)
+        self.set_uniform(name, glUniformMatrix4fv, 1, GL_TRUE, mat)
 
 
 class TextureUnit:
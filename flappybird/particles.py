@@ -0,0 +1,137 @@
+import math
+import numpy as np
+from . import gllib as gl
+from . import config
+
+
+class ParticleKind:
+    # (x, y, w, h) on texture.png
+    textureRect = None
+    # Seconds
+    life = 1.
+    # Pixels per second, (min, max)
+    speed = (0., 0.)
+    # Emission direction in radians, (min, max)
+    direction = (0., 2 * math.pi)
+    # Pixels per second squared
+    gravity = 0.
+    # Maximum angular speed in radians per second
+    spin = 0.
+    # Positions are scattered uniformly inside this (w, h) area
+    spread = (0., 0.)
+
+
+class Feather(ParticleKind):
+    textureRect = (270, 66, 2, 2)
+    life = 1.2
+    speed = (20., 70.)
+    gravity = 60.
+    spin = 8.
+    spread = (8., 6.)
+
+
+class Dust(ParticleKind):
+    textureRect = (146, 7, 2, 2)
+    life = .6
+    speed = (5., 20.)
+    direction = (math.pi / 4, math.pi * 3 / 4)
+    gravity = 30.
+    spread = (6., 0.)
+
+
+class Sparkle(ParticleKind):
+    textureRect = (274, 66, 2, 2)
+    life = .5
+    speed = (30., 60.)
+    spin = 4.
+    spread = (4., 4.)
+
+
+class ParticleSystem:
+    """
+    Transient visuals kept in flat arrays. Live particles always occupy the
+    first `count` rows, so updating and drawing never touch Python objects.
+    """
+    kinds = [Feather, Dust, Sparkle]
+
+    def __init__(self, capacity=config.maxParticles):
+        self.capacity = capacity
+        self.count = 0
+        # (x, y, angle, atlasId) rows, uploaded to Render as is
+        self.sprite = np.zeros((capacity, 4), dtype=gl.GLfloat)
+        self.alpha = np.zeros(capacity, dtype=gl.GLfloat)
+        self.velocity = np.zeros((capacity, 2), dtype=gl.GLfloat)
+        self.gravity = np.zeros(capacity, dtype=gl.GLfloat)
+        self.spin = np.zeros(capacity, dtype=gl.GLfloat)
+        self.life = np.zeros(capacity, dtype=gl.GLfloat)
+        self.maxLife = np.ones(capacity, dtype=gl.GLfloat)
+        self.kind = np.zeros(capacity, dtype=np.intp)
+        self._kindIds = {kind: i for i, kind in enumerate(self.kinds)}
+        self._atlasIds = None
+        self._arrays = [
+            self.sprite, self.velocity, self.gravity, self.spin, self.life,
+            self.maxLife, self.kind,
+        ]
+
+    def __len__(self):
+        return self.count
+
+    def emit(self, kind, n, pos):
+        """
+        Spawn up to n particles of the given kind around pos. Particles that
+        do not fit into the capacity are dropped.
+        """
+        n = min(n, self.capacity - self.count)
+        if n <= 0:
+            return
+        s = slice(self.count, self.count + n)
+        uniform = np.random.uniform
+        angles = uniform(kind.direction[0], kind.direction[1], n)
+        speeds = uniform(kind.speed[0], kind.speed[1], n)
+        w, h = kind.spread
+        self.sprite[s, 0] = pos[0] + uniform(-w / 2, w / 2, n)
+        self.sprite[s, 1] = pos[1] + uniform(-h / 2, h / 2, n)
+        self.sprite[s, 2] = uniform(0, 2 * math.pi, n) if kind.spin else 0.
+        self.velocity[s, 0] = np.cos(angles) * speeds
+        self.velocity[s, 1] = np.sin(angles) * speeds
+        self.gravity[s] = kind.gravity
+        self.spin[s] = uniform(-kind.spin, kind.spin, n)
+        self.life[s] = self.maxLife[s] = uniform(kind.life / 2, kind.life, n)
+        self.kind[s] = self._kindIds[kind]
+        self.count += n
+
+    def scroll(self, dx):
+        self.sprite[:self.count, 0] += dx
+
+    def clear(self):
+        self.count = 0
+
+    def update(self, dt):
+        n = self.count
+        if n == 0:
+            return
+        life = self.life[:n]
+        life -= dt
+        alive = life > 0
+        if not alive.all():
+            # Compact the survivors to the front, keeping their order
+            idx = np.flatnonzero(alive)
+            n = self.count = len(idx)
+            for array in self._arrays:
+                array[:n] = array[idx]
+        velocity = self.velocity[:n]
+        velocity[:, 1] -= self.gravity[:n] * dt
+        sprite = self.sprite[:n]
+        sprite[:, 0:2] += velocity * dt
+        sprite[:, 2] += self.spin[:n] * dt
+        np.divide(self.life[:n], self.maxLife[:n], out=self.alpha[:n])
+
+    def draw(self, render):
+        n = self.count
+        if self._atlasIds is None:
+            for kind in self.kinds:
+                render.register_box(kind, kind.textureRect)
+            self._atlasIds = render.atlas_ids(self.kinds)
+        sprite = self.sprite[:n]
+        sprite[:, 3] = self._atlasIds[self.kind[:n]]
+        render.draw_batch(sprite, self.alpha[:n])
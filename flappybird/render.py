@@ -10,6 +10,56 @@ def get_resource_path(*subPath):
     return os.path.join(os.path.dirname(__file__), *subPath)
 
 
+def fit_viewport(windowSize, sceneSize, scaleMode):
+    """
+    Return the (x, y, w, h) window rectangle the scene is upscaled into.
+    scaleMode: 'integer' keeps whole pixel multiples, 'fit' letterboxes with
+    any scale, 'stretch' fills the whole window.
+    """
+    W, H = windowSize
+    w, h = sceneSize
+    if scaleMode == 'stretch':
+        return (0, 0, W, H)
+    scale = min(W / w, H / h)
+    if scaleMode == 'integer':
+        scale = max(1, int(scale))
+    elif scaleMode != 'fit':
+        raise ValueError('Unknown scale mode: {}'.format(scaleMode))
+    vw = int(w * scale)
+    vh = int(h * scale)
+    return ((W - vw) // 2, (H - vh) // 2, vw, vh)
+
+
+def atlas_boxes():
+    """
+    Find the sprites marked on spritemask.png.
+    Return ({maskColor: (x0, y0, x1, y1)}, (w, h)). Boxes are in texels of
+    texture.png with the origin at the bottom-left corner, covering the outer
+    edges of their texels so a sprite spans exactly its size in scene pixels.
+    """
+    image = Image.open(get_resource_path('images', 'spritemask.png'))
+    data = image.load()
+    w, h = image.size
+    pixels = {}
+    for x in range(w):
+        for y in range(h):
+            color = data[x, y]
+            if color[3] == 0:
+                continue
+            color = color[:3]
+            pixel = (x, h - y)
+            if color not in pixels:
+                pixels[color] = [pixel]
+            else:
+                pixels[color].append(pixel)
+    boxes = {}
+    for color, colorPixels in pixels.items():
+        xs = [x for x, _ in colorPixels]
+        ys = [y for _, y in colorPixels]
+        boxes[color] = (min(xs), min(ys) - 1, max(xs) + 1, max(ys))
+    return boxes, (w, h)
+
+
 class ArrayBuffer(gl.GLResource):
     def __init__(self, usageHint):
         super().__init__()
@@ -23,8 +73,8 @@ class ArrayBuffer(gl.GLResource):
         gl.glDeleteBuffers(1, [self.glId])
 
     def set_data(self, data):
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.glId)
-        gl.glBufferData(gl.GL_ARRAY_BUFFER, data, self.usageHint)
+        gl.state.bind_buffer(gl.GL_ARRAY_BUFFER, self.glId)
+        gl.state.buffer_data(gl.GL_ARRAY_BUFFER, data, self.usageHint)
 
 
 class Texture(gl.Texture2D):
@@ -37,6 +87,9 @@ class Texture(gl.Texture2D):
 
 
 class Render(gl.Program):
+    # Size of the boxes uniform array in sprite.g.glsl
+    MAX_BOXES = 30
+
     def __init__(self):
         super().__init__([
             (get_resource_path('shaders', 'sprite.v.glsl'), gl.GL_VERTEX_SHADER),
@@ -50,70 +103,123 @@ class Render(gl.Program):
         self._make_boxes()
         self._arrayBuffers = [
             ArrayBuffer(gl.GL_DYNAMIC_DRAW), ArrayBuffer(gl.GL_DYNAMIC_DRAW)]
+        # Reused by draw_sprites, grown when a context has more sprites
+        self._spriteData = np.zeros((0, 4), dtype=gl.GLfloat)
+        self._alphaData = np.zeros(0, dtype=gl.GLfloat)
         self.texture = Texture()
         self.textureUnit = gl.TextureUnit(0)
 
     def _make_boxes(self):
-        image = Image.open(get_resource_path('images', 'spritemask.png'))
-        data = image.load()
-        w, h = image.size
-        boxes = {}
-        for x in range(w):
-            for y in range(h):
-                color = data[x, y]
-                if color[3] == 0:
-                    continue
-                color = color[:3]
-                pixel = (x, h - y)
-                if color not in boxes:
-                    boxes[color] = [pixel]
-                else:
-                    boxes[color].append(pixel)
-        id = 0
+        boxes, textureSize = atlas_boxes()
         boxesArray = np.zeros((len(boxes), 4), dtype=gl.GLfloat)
         colorToId = {}
-        for color, pixels in boxes.items():
-            xs = [x for x, _ in pixels]
-            ys = [y for _, y in pixels]
-            boxesArray[id] = (min(xs), min(ys), max(xs) + 0, max(ys) + 0)
+        for id, (color, box) in enumerate(boxes.items()):
+            boxesArray[id] = box
             colorToId[color] = id
-            id += 1
         self._boxesArray = boxesArray
         self._maskColorToId = colorToId
-        self._textureSize = (w, h)
+        self._textureSize = textureSize
 
     def free(self):
         for buf in self._arrayBuffers:
             buf.free()
 
+    def register_box(self, key, rect):
+        """
+        Add an atlas entry for a sub-rectangle of texture.png and return its id.
+        rect: (x, y, w, h) in image pixels, origin at the top-left corner.
+        """
+        if key in self._maskColorToId:
+            return self._maskColorToId[key]
+        if len(self._boxesArray) >= self.MAX_BOXES:
+            raise ValueError('Too many atlas boxes: {}'.format(key))
+        x, y, w, h = rect
+        H = self._textureSize[1]
+        box = np.array([[x, H - y - h, x + w, H - y]], dtype=gl.GLfloat)
+        self._boxesArray = np.vstack([self._boxesArray, box])
+        id = self._maskColorToId[key] = len(self._boxesArray) - 1
+        return id
+
+    def atlas_ids(self, keys):
+        """
+        Map mask colors (or registered box keys) to an array of atlas ids,
+        usable as a lookup table for batches.
+        """
+        return np.array(
+            [self._maskColorToId[key] for key in keys], dtype=gl.GLfloat)
+
     def draw_sprites(self, sprites):
         """
         Draw sprites in given order
         """
-        spriteBuf, alphaBuf = self._arrayBuffers
         sprites = [sp for sp in sprites if sp.maskColor]
+        n = len(sprites)
+        if n > len(self._spriteData):
+            self._spriteData = np.zeros((n, 4), dtype=gl.GLfloat)
+            self._alphaData = np.zeros(n, dtype=gl.GLfloat)
 
-        spriteBufData = np.zeros((len(sprites), 4), dtype=gl.GLfloat)
+        spriteBufData = self._spriteData[:n]
+        alphaBufData = self._alphaData[:n]
         for i, sp in enumerate(sprites):
             spriteBufData[i, 0:2] = sp.screenPos
             spriteBufData[i, 2] = sp.angle
             spriteBufData[i, 3] = self._maskColorToId[sp.maskColor]
-            # print(sp, self._boxesArray[self._maskColorToId[sp.maskColor]])
-        spriteBuf.set_data(spriteBufData)
+            alphaBufData[i] = sp.alpha
+        self.draw_batch(spriteBufData, alphaBufData)
 
-        alphaBufData = np.array([sp.alpha for sp in sprites], dtype=gl.GLfloat)
-        alphaBuf.set_data(alphaBufData)
+    def draw_batch(self, spriteData, alphaData):
+        """
+        Draw many points with one call.
+        spriteData: (n, 4) GLfloat array of (x, y, angle, atlasId) rows
+        alphaData: (n,) GLfloat array
+        """
+        if len(spriteData) == 0:
+            return
+        spriteBuf, alphaBuf = self._arrayBuffers
+        spriteBuf.set_data(spriteData)
+        alphaBuf.set_data(alphaData)
         # Setup buffers
         self.set_buffer('sprite', spriteBuf)
         self.set_buffer('alphaIn', alphaBuf)
         # Setup uniforms
-        gl.glUniform4fv(
-            self.get_uniform_loc('boxes'), len(self._boxesArray), self._boxesArray)
-        gl.glUniform2fv(
-            self.get_uniform_loc('screenSize'), 1, self._screenSize)
+        self.set_uniform(
+            'boxes', gl.glUniform4fv, len(self._boxesArray), self._boxesArray)
+        self.set_uniform('screenSize', gl.glUniform2fv, 1, self._screenSize)
         # Setup texture
-        gl.glActiveTexture(self.textureUnit.glenum)
-        gl.glUniform1i(self.get_uniform_loc('textureSampler'), self.textureUnit.id)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture.glId)
+        gl.state.active_texture(self.textureUnit.glenum)
+        self.set_uniform('textureSampler', gl.glUniform1i, self.textureUnit.id)
+        gl.state.bind_texture(gl.GL_TEXTURE_2D, self.texture.glId)
         # Draw
-        self.draw(gl.GL_POINTS, len(sprites))
+        self.draw(gl.GL_POINTS, len(spriteData))
+
+
+class SceneTarget(gl.Framebuffer):
+    """
+    The native resolution framebuffer every sprite is rasterized into.
+    """
+    def __init__(self):
+        super().__init__(config.screenWidth, config.screenHeight)
+
+
+class Upscaler(gl.Program):
+    """
+    Copies the scene texture onto the window with a single quad.
+    """
+    def __init__(self):
+        super().__init__([
+            (get_resource_path('shaders', 'upscale.v.glsl'), gl.GL_VERTEX_SHADER),
+            (get_resource_path('shaders', 'upscale.f.glsl'), gl.GL_FRAGMENT_SHADER),
+        ], [])
+        self.textureUnit = gl.TextureUnit(0)
+
+    def prepare_draw(self):
+        gl.state.disable(gl.GL_BLEND)
+
+    def post_draw(self):
+        gl.state.enable(gl.GL_BLEND)
+
+    def draw_texture(self, textureId):
+        gl.state.active_texture(self.textureUnit.glenum)
+        self.set_uniform('sceneSampler', gl.glUniform1i, self.textureUnit.id)
+        gl.state.bind_texture(gl.GL_TEXTURE_2D, textureId)
+        self.draw(gl.GL_TRIANGLE_STRIP, 4)
@@ -0,0 +1,169 @@
+import statistics
+import time
+from collections import deque
+import pyglet
+from . import config
+
+clock = time.perf_counter
+# Weight of the newest sample in the cost averages
+SMOOTHING = .1
+# Bounds of the sleep margin, in seconds
+MIN_MARGIN = .0002
+MAX_MARGIN = .004
+
+
+class FrameStats:
+    """
+    Frame pacing over the last config.statsWindow presented frames.
+    jitter is the standard deviation of the time between presented frames.
+    An update that starts more than one period after its deadline counts as
+    a missed deadline.
+    """
+    def __init__(self, period, window=config.statsWindow):
+        self.period = period
+        self.intervals = deque(maxlen=window)
+        self.updateCost = 0.
+        self.drawCost = 0.
+        self.updates = 0
+        self.draws = 0
+        self.missedDeadlines = 0
+        self.skippedDraws = 0
+        self._lastPresent = None
+
+    def add_update(self, cost, lateness):
+        self.updateCost += (cost - self.updateCost) * SMOOTHING
+        self.updates += 1
+        if lateness > self.period:
+            self.missedDeadlines += 1
+
+    def add_draw(self, cost, presented):
+        self.drawCost += (cost - self.drawCost) * SMOOTHING
+        self.draws += 1
+        if self._lastPresent is not None:
+            self.intervals.append(presented - self._lastPresent)
+        self._lastPresent = presented
+
+    @property
+    def jitter(self):
+        if len(self.intervals) < 2:
+            return 0.
+        return statistics.pstdev(self.intervals)
+
+    def __repr__(self):
+        return ('FrameStats(updates={}, draws={}, skipped={}, missed={}, '
+                'jitter={:.2f}ms, update={:.2f}ms, draw={:.2f}ms)').format(
+            self.updates, self.draws, self.skippedDraws, self.missedDeadlines,
+            self.jitter * 1e3, self.updateCost * 1e3, self.drawCost * 1e3)
+
+
+class FrameScheduler:
+    """
+    Drives a window in place of pyglet.app.run, with a fixed simulation step
+    of 1 / fps. Every step is simulated, late ones back to back, so the game
+    clock never slows down; when a frame would miss its deadline it is the
+    drawing that gives way.
+    Waiting sleeps for most of the time left and spins the rest. The spin
+    margin follows how much time.sleep overshoots on this machine.
+    """
+    def __init__(self, window, update, idle=None, mustDraw=None,
+                 fps=config.FPS, vsync=config.vsync):
+        self.window = window
+        self.update = update
+        # Returns whether the last update has to be drawn before the next
+        # one runs, e.g. when its image is recorded. Such draws are never
+        # skipped.
+        self.mustDraw = mustDraw
+        # Background work, run while a frame has time to spare. Returns
+        # whether there is more to do.
+        self.idle = idle
+        self.idleCost = 0.
+        self.period = 1 / fps
+        self.vsync = vsync
+        self.stats = FrameStats(self.period)
+        self.margin = MAX_MARGIN / 2
+        self._deadline = None
+        self._skipped = 0
+
+    def sleep_until(self, deadline):
+        remaining = deadline - clock()
+        if remaining > self.margin:
+            requested = remaining - self.margin
+            start = clock()
+            time.sleep(requested)
+            oversleep = clock() - start - requested
+            # Grow at once, a late wake up costs a frame; shrink slowly
+            if oversleep > self.margin:
+                self.margin = min(oversleep * 1.25, MAX_MARGIN)
+            else:
+                self.margin = max(self.margin * (1 - SMOOTHING), MIN_MARGIN)
+        while clock() < deadline:
+            pass
+
+    def step(self):
+        """
+        Run the updates that are due, at most config.maxCatchUpUpdates, then
+        draw unless that would make the next update late.
+        """
+        mustDraw = self.mustDraw
+        updates = 0
+        while clock() >= self._deadline\
+                and updates < config.maxCatchUpUpdates\
+                and not (updates and mustDraw is not None and mustDraw()):
+            start = clock()
+            if start - self._deadline > config.maxFrameLag:
+                # Stalled for long (suspended, dragged window, updates
+                # slower than the frame rate): resume from now instead of
+                # fast forwarding through it
+                self._deadline = start
+            self.update(self.period)
+            self.stats.add_update(clock() - start, start - self._deadline)
+            self._deadline += self.period
+            updates += 1
+        if not updates:
+            return
+        if clock() + self.stats.drawCost > self._deadline\
+                and self._skipped < config.maxSkippedDraws\
+                and not (mustDraw is not None and mustDraw()):
+            self._skipped += 1
+            self.stats.skippedDraws += 1
+            return
+        self._skipped = 0
+        window = self.window
+        start = clock()
+        window.switch_to()
+        window.dispatch_event('on_draw')
+        if self.vsync:
+            # Waiting for the refresh is pacing, not cost
+            cost = clock() - start
+            window.flip()
+        else:
+            window.flip()
+            cost = clock() - start
+        self.stats.add_draw(cost, clock())
+
+    def run_idle(self):
+        """
+        Run idle work while the next update is further away than the work
+        has taken so far.
+        """
+        if self.idle is None:
+            return
+        while self._deadline - clock() > self.idleCost + self.margin:
+            start = clock()
+            more = self.idle()
+            self.idleCost = max(self.idleCost * (1 - SMOOTHING), clock() - start)
+            if not more:
+                return
+
+    def run(self):
+        window = self.window
+        eventLoop = pyglet.app.event_loop
+        self._deadline = clock()
+        while not (window.has_exit or eventLoop.has_exit):
+            pyglet.clock.tick()
+            window.dispatch_events()
+            self.step()
+            self.run_idle()
+            # The flip only paces draws, with vsync or without the next
+            # update is still waited for here
+            self.sleep_until(self._deadline)
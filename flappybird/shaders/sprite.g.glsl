@@ -32,8 +32,8 @@ void main() {
         alphaOut = alpha[0];
         vec2 posViewSpace = pos[0] + rotation * (posTexSpace - centerTexSpace);
         gl_Position = vec4(
-            posViewSpace.x / screenSize.x * 2.010,
-            posViewSpace.y / screenSize.y * 2.010,
+            posViewSpace.x / screenSize.x * 2.0,
+            posViewSpace.y / screenSize.y * 2.0,
             0, 1
         );
         EmitVertex();
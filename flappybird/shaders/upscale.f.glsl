@@ -0,0 +1,9 @@
+# version 330 core
+in vec2 texcoord;
+out vec4 fragColor;
+
+uniform sampler2D sceneSampler;
+
+void main() {
+    fragColor = vec4(texture(sceneSampler, texcoord).rgb, 1);
+}
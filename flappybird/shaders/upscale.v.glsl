@@ -0,0 +1,8 @@
+# version 330 core
+out vec2 texcoord;
+
+void main() {
+    vec2 corner = vec2(gl_VertexID & 1, gl_VertexID >> 1);
+    texcoord = corner;
+    gl_Position = vec4(corner * 2.0 - 1.0, 0, 1);
+}
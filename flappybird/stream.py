@@ -0,0 +1,333 @@
+import asyncio
+import threading
+from . import config
+from . import sprites
+from .bird import Bird
+from .game import Context, GameState
+
+STATES = [
+    GameState.ready, GameState.entering, GameState.flyying,
+    GameState.falling, GameState.showboard,
+]
+# Fixed point scales of the streamed values
+Y_SCALE = 4
+ANGLE_SCALE = 64
+# Number of keyframes kept for clients that have not acknowledged a newer one
+KEPT_KEYFRAMES = 4
+
+
+def snapshot(game):
+    """
+    Quantize the visible state of a game into a tuple of ints:
+    (state, viewX, score, birdY, birdAngle, birdFrame, x0, offset0, x1, ...)
+    """
+    bird = game.bird
+    values = [
+        STATES.index(game.state), game._viewX, game.score,
+        round(float(bird.screenPos[1]) * Y_SCALE),
+        round(bird.angle * ANGLE_SCALE), bird.currentFrame,
+    ]
+    for pillar in game.upperPillars:
+        values.append(round(pillar.x))
+        values.append(pillar.offset)
+    return tuple(values)
+
+
+def zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def unzigzag(n):
+    return n // 2 if n % 2 == 0 else -(n + 1) // 2
+
+
+class BitWriter:
+    def __init__(self):
+        self._value = 0
+        self._length = 0
+
+    def write(self, value, bits):
+        self._value = (self._value << bits) | value
+        self._length += bits
+
+    def write_gamma(self, n):
+        "Elias gamma code of n >= 1, small numbers take few bits."
+        bits = n.bit_length()
+        self.write(n, 2 * bits - 1)
+
+    def write_signed(self, n):
+        self.write_gamma(zigzag(n) + 1)
+
+    def getvalue(self):
+        pad = -self._length % 8
+        return (self._value << pad).to_bytes((self._length + pad) // 8, 'big')
+
+
+class BitReader:
+    def __init__(self, data):
+        self._value = int.from_bytes(data, 'big')
+        self._length = len(data) * 8
+        self._pos = 0
+
+    def read(self, bits):
+        self._pos += bits
+        return (self._value >> (self._length - self._pos)) & ((1 << bits) - 1)
+
+    def read_gamma(self):
+        zeros = 0
+        while not self.read(1):
+            zeros += 1
+        return (1 << zeros) | self.read(zeros)
+
+    def read_signed(self):
+        return unzigzag(self.read_gamma() - 1)
+
+
+def encode_keyframe(keyId, values):
+    writer = BitWriter()
+    writer.write(keyId, 8)
+    for value in values:
+        writer.write_signed(value)
+    return writer.getvalue()
+
+
+def encode_delta(keyId, base, values):
+    """
+    Encode values against the keyframe base: one bit per field telling
+    whether it changed, then the differences of the changed ones.
+    """
+    writer = BitWriter()
+    writer.write(0x80 | keyId, 8)
+    for old, new in zip(base, values):
+        writer.write(old != new, 1)
+    for old, new in zip(base, values):
+        if old != new:
+            writer.write_signed(new - old)
+    return writer.getvalue()
+
+
+def decode(message, keyframes, nFields):
+    """
+    Return (keyId, isKeyframe, values). Deltas are applied to the matching
+    entry of keyframes.
+    """
+    reader = BitReader(message)
+    header = reader.read(8)
+    keyId = header & 0x7f
+    if not header & 0x80:
+        return keyId, True, tuple(reader.read_signed() for _ in range(nFields))
+    base = keyframes[keyId]
+    changed = [reader.read(1) for _ in range(nFields)]
+    return keyId, False, tuple(
+        value + reader.read_signed() if flag else value
+        for value, flag in zip(base, changed))
+
+
+def frame(message):
+    return bytes([len(message)]) + message
+
+
+class _Viewer:
+    def __init__(self, writer):
+        self.writer = writer
+        self.acked = None
+        self.sentKey = None
+
+
+class StreamServer:
+    """
+    Broadcasts game snapshots to spectators from an asyncio loop running in
+    a background thread. publish() only hands the snapshot over to that loop,
+    so the pyglet loop never waits on the network.
+    Each viewer receives deltas against the last keyframe it acknowledged.
+    A new keyframe is made once deltas grow past config.streamKeyBytes.
+    """
+    def __init__(self, host=config.streamHost, port=config.streamPort):
+        self.host = host
+        self.port = port
+        self._loop = None
+        self._server = None
+        self._viewers = set()
+        self._keyframes = {}
+        self._keyId = None
+        self._frameCount = 0
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._serve, self.host, self.port),
+            self._loop).result()
+
+    def stop(self):
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+    def __len__(self):
+        return len(self._viewers)
+
+    def publish(self, game):
+        """
+        Queue the state of game for broadcasting. Called every frame, sends
+        at config.streamRate.
+        """
+        self._frameCount += 1
+        if self._loop is None or self._frameCount % (config.FPS // config.streamRate):
+            return
+        self._loop.call_soon_threadsafe(self._broadcast, snapshot(game))
+
+    def _new_keyframe(self, values):
+        keyId = 0 if self._keyId is None else (self._keyId + 1) % 128
+        self._keyframes[keyId] = values
+        evicted = (keyId - KEPT_KEYFRAMES) % 128
+        if self._keyframes.pop(evicted, None) is not None:
+            # The id will be reused, forget it so that viewers get the new
+            # keyframe and no deltas against the old one
+            for viewer in self._viewers:
+                if viewer.acked == evicted:
+                    viewer.acked = None
+                if viewer.sentKey == evicted:
+                    viewer.sentKey = None
+        self._keyId = keyId
+        return keyId
+
+    def _broadcast(self, values):
+        if self._keyId is None or len(encode_delta(
+                self._keyId, self._keyframes[self._keyId], values))\
+                > config.streamKeyBytes:
+            self._new_keyframe(values)
+        keyId = self._keyId
+        keyMessage = frame(encode_keyframe(keyId, self._keyframes[keyId]))
+        deltas = {}
+        for viewer in list(self._viewers):
+            transport = viewer.writer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > config.streamMaxBacklog:
+                # Too slow to keep up, drop frames instead of queueing them
+                continue
+            base = viewer.acked
+            if base != keyId and viewer.sentKey != keyId:
+                viewer.writer.write(keyMessage)
+                viewer.sentKey = keyId
+            if base not in self._keyframes:
+                # Not acknowledged yet, or so long ago the keyframe is gone.
+                # The viewer has the current keyframe in flight before this.
+                base = keyId
+            if base not in deltas:
+                deltas[base] = frame(
+                    encode_delta(base, self._keyframes[base], values))
+            viewer.writer.write(deltas[base])
+
+    async def _serve(self, reader, writer):
+        viewer = _Viewer(writer)
+        self._viewers.add(viewer)
+        try:
+            while True:
+                acks = await reader.read(16)
+                if not acks:
+                    break
+                if acks[-1] in self._keyframes:
+                    viewer.acked = acks[-1]
+        except ConnectionError:
+            pass
+        finally:
+            self._viewers.discard(viewer)
+            writer.close()
+
+
+class StreamClient:
+    """
+    Receives a game stream in a background thread. latest() returns the most
+    recent decoded snapshot, or None before the first keyframe.
+    """
+    def __init__(self, host=config.streamHost, port=config.streamPort):
+        self.host = host
+        self.port = port
+        self._values = None
+        self._keyframes = {}
+        self._nFields = 6 + 2 * config.nPillars
+        self._loop = None
+        self._task = None
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        # The loop only keeps weak references to its tasks
+        self._task = asyncio.run_coroutine_threadsafe(self._receive(), self._loop)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+    def latest(self):
+        return self._values
+
+    async def _receive(self):
+        while True:
+            try:
+                await self._receive_stream()
+            except (OSError, asyncio.IncompleteReadError, KeyError) as e:
+                print('Stream from {}:{} lost: {!r}, reconnecting'.format(
+                    self.host, self.port, e))
+            # Deltas of the next connection refer to its own keyframes
+            self._keyframes = {}
+            await asyncio.sleep(config.streamRetryDelay)
+
+    async def _receive_stream(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            while True:
+                length = (await reader.readexactly(1))[0]
+                message = await reader.readexactly(length)
+                keyId, isKeyframe, values = decode(
+                    message, self._keyframes, self._nFields)
+                if isKeyframe:
+                    self._keyframes[keyId] = values
+                    self._keyframes.pop((keyId - KEPT_KEYFRAMES) % 128, None)
+                    writer.write(bytes([keyId]))
+                self._values = values
+        finally:
+            writer.close()
+
+
+class Spectator(Context):
+    """
+    Shows a game streamed by a StreamServer.
+    """
+    def __init__(self, app):
+        super().__init__(app)
+        self.client = app.streamClient
+        self.bird = Bird()
+        self.upperPillars = [sprites.UpperPillar() for _ in range(config.nPillars)]
+        self.lowerPillars = [sprites.LowerPillar() for _ in range(config.nPillars)]
+        self.floor = sprites.Floor()
+        self.sprites = [sprites.Background()] + self.upperPillars\
+            + self.lowerPillars + [self.bird, self.floor]
+        self._values = None
+        self._viewX = 0
+
+    def update(self, dt):
+        values = self.client.latest()
+        if values is None:
+            return
+        state, viewX, score, birdY, birdAngle, birdFrame = values[:6]
+        if values is not self._values:
+            self._values = values
+            self._viewX = viewX
+        elif STATES[state] in (GameState.entering, GameState.flyying):
+            # Keep scrolling between updates, the stream is slower than FPS
+            self._viewX += config.scrollDistancePerFrame
+        self.bird.screenPos[1] = birdY / Y_SCALE
+        self.bird.angle = birdAngle / ANGLE_SCALE
+        self.bird.currentFrame = birdFrame
+        pillars = values[6:]
+        for i in range(config.nPillars):
+            x, offset = pillars[2 * i], pillars[2 * i + 1]
+            for pillar in (self.upperPillars[i], self.lowerPillars[i]):
+                pillar.screenPos = (x - self._viewX, pillar.initY + offset)
+        self.floor.screenPos[0] = -self._viewX % 7 - 3